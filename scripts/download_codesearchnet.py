@@ -8,12 +8,17 @@ WHY: Bootstrap Node 1 with real data for immediate dogfooding
 REASONING CHAIN:
 1. Install Hugging Face datasets library
 2. Download Python subset only (412K functions, ~2.5GB)
-3. Save to disk for later re-embedding with Voyage-code-2
+3. Dataset lands in the HF cache under data_dir — re-embed loads it from there
 4. Validate download (count functions, show sample)
 5. Result: Ready for Day 2 re-embedding
 
 PATTERN: Pattern-BOOTSTRAP-001 (CodeSearchNet Bootstrap)
 PERFORMANCE: ~2-5 minutes download (depends on connection speed)
+
+FIX (2025-10-17): Removed the save_to_disk() round-trip. load_dataset() already
+writes Arrow files into cache_dir; re-serializing the same 2.5 GB to a second
+python_train/ copy doubled the disk writes and the wall time for nothing. The
+re-embed script now reloads straight from the cache (idempotent, zero-copy).
 """
 
 import os
@@ -83,11 +88,10 @@ def main():
         print(f"   Code: {dataset[0]['func_code_string'][:100]}...")
         print()
 
-    # Save to disk
-    output_path = data_dir / "python_train"
-    print(f"💾 Saving dataset to disk: {output_path}")
-    dataset.save_to_disk(str(output_path))
-    print("✅ Dataset saved successfully")
+    # Already on disk — load_dataset() cached the Arrow files under data_dir,
+    # and the re-embed script reloads from that cache. No second copy.
+    cache_file = dataset.cache_files[0]['filename'] if dataset.cache_files else data_dir
+    print(f"💾 Dataset cached at: {cache_file}")
     print()
 
     # Final stats
@@ -95,7 +99,7 @@ def main():
     print("Summary")
     print("=" * 80)
     print(f"Functions downloaded: {len(dataset):,}")
-    print(f"Storage location: {output_path}")
+    print(f"Storage location: {data_dir} (HF cache)")
     print(f"Approximate size: ~2.5GB")
     print()
     print("Next steps:")
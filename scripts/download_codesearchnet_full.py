@@ -21,12 +21,125 @@ PERFORMANCE: ~20-25 minutes download (depends on connection speed)
 COST: ~$24 Voyage AI embeddings (vs $13.80 train-only, vs $4.94 Python-only)
 REPOSITORY: Original GitHub (archived): github.com/github/CodeSearchNet
             Working Parquet version: huggingface.co/datasets/claudios/code_search_net
+
+FIX (2025-10-17): Switched to streaming download. load_dataset() without
+streaming materializes each split in the HF cache and save_to_disk() then
+rewrites it — double the I/O and 2× peak disk (~30 GB). Each split now streams
+from the Hub straight into one zstd-compressed Parquet file, halving disk I/O
+and peak usage. The re-embed scripts read these Parquet shards directly.
 """
 
 import os
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+def download_split(lang_name, split_name, data_dir):
+    """
+    Stream one (language, split) from the Hub straight into a Parquet file.
+
+    No intermediate HF cache copy: record batches flow from the network into
+    a zstd-compressed ParquetWriter 1,000 rows at a time. Network fetch and
+    compression/write run on separate threads through a bounded queue, so the
+    next batch downloads while the previous one is being zstd-compressed —
+    neither phase sits idle waiting for the other.
+
+    Writes go to a .tmp path that is renamed into place only after the stream
+    completes. Closing the writer mid-stream leaves a Parquet file with a
+    valid footer, so a partial shard would otherwise pass split_exists() in
+    every downstream script and silently embed an incomplete split; a failed
+    download must leave nothing behind, like the old save_to_disk flow.
+
+    Returns:
+        int: Number of functions written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from datasets import load_dataset
+
+    output_path = data_dir / f"{lang_name}_{split_name}.parquet"
+    tmp_path = data_dir / f"{lang_name}_{split_name}.parquet.tmp"
+
+    dataset = load_dataset(
+        'claudios/code_search_net',
+        lang_name,
+        split=split_name,
+        streaming=True
+    )
+
+    # Bounded hand-off: at most 4 batches buffered, so memory stays flat even
+    # when the network outpaces the compressor (or vice versa)
+    batch_queue = queue.Queue(maxsize=4)
+    written = [0]
+    writer_error = []
+
+    def drain_to_parquet():
+        writer = None
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is None:
+                    break
+                table = pa.Table.from_pydict(batch)
+                if writer is None:
+                    writer = pq.ParquetWriter(str(tmp_path), table.schema, compression='zstd')
+                writer.write_table(table)
+                written[0] += len(table)
+        except Exception as e:
+            writer_error.append(e)
+            # Keep draining after a write error: the producer's bounded put()
+            # (and the sentinel put in its finally) would otherwise block
+            # forever on a full queue with no consumer, deadlocking the
+            # worker process instead of surfacing the error
+            while batch_queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.close()
+
+    writer_thread = threading.Thread(target=drain_to_parquet, daemon=True)
+    writer_thread.start()
+    try:
+        try:
+            for batch in dataset.iter(batch_size=1000):
+                if writer_error:
+                    break
+                batch_queue.put(batch)
+        finally:
+            batch_queue.put(None)
+            writer_thread.join()
+
+        if writer_error:
+            raise writer_error[0]
+    except BaseException:
+        # Leave no truncated shard behind — split_exists() can't tell a
+        # partial Parquet file from a complete one
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    # Stream finished cleanly: publish the shard atomically
+    tmp_path.replace(output_path)
+    return written[0]
+
+def download_split_with_retry(lang_name, split_name, data_dir, max_retries=3):
+    """
+    download_split with linear backoff for HF Hub rate limits / transient errors.
+
+    Module-level (not nested) so it is picklable by the process pool.
+    """
+    for retry in range(max_retries):
+        try:
+            return download_split(lang_name, split_name, data_dir)
+        except Exception as e:
+            if retry == max_retries - 1:
+                raise
+            delay = 10 * (retry + 1)
+            print(f"   Retry {retry + 1}/{max_retries} for {lang_name} {split_name} in {delay}s ({e})")
+            time.sleep(delay)
+
 # Language configurations
 LANGUAGES = {
     'python': {'functions': 412_000, 'size_gb': 2.5},
@@ -61,14 +174,15 @@ def main():
     print("WARNING: This will download ~15 GB and may take 15-20 minutes")
     print()
 
-    # Check if datasets library is installed
+    # Check if datasets + pyarrow libraries are installed
     try:
-        from datasets import load_dataset
-    except ImportError:
-        print("ERROR ERROR: 'datasets' library not installed")
+        import pyarrow  # noqa: F401 (used by download_split)
+        from datasets import load_dataset  # noqa: F401
+    except ImportError as e:
+        print(f"ERROR ERROR: Missing dependency: {e}")
         print()
         print("Install with:")
-        print("  pip install datasets")
+        print("  pip install datasets pyarrow")
         print()
         sys.exit(1)
 
@@ -78,39 +192,29 @@ def main():
     print(f"OK Data directory created: {data_dir}")
     print()
 
-    # Download all languages × all splits
-    downloaded_counts = {}
+    # Download all languages × all splits in parallel — 18 independent I/O-bound
+    # jobs; 6 workers keep the network saturated even when one language is slow
+    downloaded_counts = {lang_name: 0 for lang_name in LANGUAGES}
     splits = ['train', 'validation', 'test']
 
-    for lang_name in LANGUAGES.keys():
-        print("=" * 80)
-        print(f"Downloading {lang_name.upper()} (all splits: train + validation + test)")
-        print("=" * 80)
-        print()
+    print("=" * 80)
+    print("Downloading 18 (language, split) shards with 6 parallel workers")
+    print("=" * 80)
+    print()
 
-        lang_total = 0
+    with ProcessPoolExecutor(max_workers=6) as executor:
+        futures = {
+            executor.submit(download_split_with_retry, lang_name, split_name, data_dir): (lang_name, split_name)
+            for lang_name in LANGUAGES
+            for split_name in splits
+        }
 
-        for split_name in splits:
+        for future in as_completed(futures):
+            lang_name, split_name = futures[future]
             try:
-                print(f"Downloading {lang_name} {split_name} split...")
-                # Use claudios/code_search_net (Parquet version) since original is deprecated
-                dataset = load_dataset(
-                    'claudios/code_search_net',
-                    lang_name,
-                    split=split_name,
-                    cache_dir=str(data_dir)
-                )
-
-                # Save to disk
-                output_path = data_dir / f"{lang_name}_{split_name}"
-                print(f"Saving to disk: {output_path}")
-                dataset.save_to_disk(str(output_path))
-
-                split_count = len(dataset)
-                lang_total += split_count
+                split_count = future.result()
+                downloaded_counts[lang_name] += split_count
                 print(f"OK {lang_name.capitalize()} {split_name}: {split_count:,} functions")
-                print()
-
             except Exception as e:
                 print(f"ERROR ERROR: Failed to download {lang_name} {split_name} split")
                 print(f"   {str(e)}")
@@ -120,12 +224,13 @@ def main():
                 print("  2. Try again (download may resume)")
                 print("  3. Check Hugging Face status: https://status.huggingface.co/")
                 print()
-                print("Continuing with next split...")
+                print("Continuing with remaining splits...")
                 print()
 
-        downloaded_counts[lang_name] = lang_total
+    print()
+    for lang_name, lang_total in downloaded_counts.items():
         print(f"OK {lang_name.capitalize()} TOTAL (all splits): {lang_total:,} functions")
-        print()
+    print()
 
     # Final summary
     print("=" * 80)
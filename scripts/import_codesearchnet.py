@@ -7,21 +7,31 @@ WHY: Enable immediate dogfooding with 412K searchable functions from Day 3
 
 REASONING CHAIN:
 1. Load embeddings from disk (numpy array: 412,178 × 1024)
-2. Load metadata from disk (JSON: function names, docstrings, code)
+2. Memory-map metadata from disk (Parquet: function names, docstrings, code)
 3. Connect to Supabase PostgreSQL database
-4. Batch insert 1,000 functions per transaction (for speed)
+4. Stream rows via COPY ... FROM STDIN, 1,000 functions per transaction
 5. Validate: SELECT COUNT(*) → 412,178
 6. Result: 412K searchable functions ready for unified search
 
 PATTERN: Pattern-BOOTSTRAP-001 (CodeSearchNet Bootstrap)
-PERFORMANCE: ~1-2 hours for 412K functions (bulk insert)
+PERFORMANCE: ~10-15 min for 412K functions (COPY, was 1-2 hours with batched INSERTs)
+
+FIX (2025-10-17): Replaced execute_batch with COPY FROM STDIN. execute_batch
+still round-trips INSERT statements internally (per-row parse/plan), which
+dominated the 1-2 hour import. COPY streams tab-delimited rows in one protocol
+message per batch — typically ~10× faster for bulk loads. Text format chosen
+over binary: pgvector accepts its '[x,y,...]' text representation directly and
+we avoid hand-rolling the binary wire framing.
 """
 
+import io
 import os
 import sys
 import json
+from itertools import islice
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 def main():
@@ -33,7 +43,7 @@ def main():
     # Check dependencies
     try:
         import psycopg2
-        from psycopg2.extras import execute_batch
+        from psycopg2.extras import execute_values
     except ImportError:
         print("❌ ERROR: psycopg2 not installed")
         print()
@@ -66,27 +76,59 @@ def main():
         sys.exit(1)
 
     print(f"📂 Loading embeddings from {embeddings_path}...")
-    embeddings = np.load(embeddings_path)
-    print(f"✅ Loaded embeddings: {embeddings.shape} (412,178 × 1024)")
+    # Memory-map instead of reading 1.6 GB into RAM — rows are only touched
+    # (and converted to Python lists) one insert batch at a time
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    print(f"✅ Mapped embeddings: {embeddings.shape} (412,178 × 1024)")
     print()
 
-    # Load metadata
-    metadata_path = Path("./data/codesearchnet/python_metadata.json")
-    if not metadata_path.exists():
-        print(f"❌ ERROR: Metadata not found at {metadata_path}")
-        print()
-        print("Run re-embedding script first:")
-        print("  python scripts/re_embed_codesearchnet.py")
-        sys.exit(1)
-
-    print(f"📂 Loading metadata from {metadata_path}...")
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-    print(f"✅ Loaded metadata: {len(metadata):,} records")
+    # Load metadata — Parquet written by the re-embed script, memory-mapped
+    # (zero-copy, columnar). Legacy JSONL/JSON accepted for older runs.
+    metadata_path = Path("./data/codesearchnet/python_metadata.parquet")
+    meta_table = None
+    metadata = None
+
+    if metadata_path.exists():
+        import pyarrow.parquet as pq
+        print(f"📂 Mapping metadata from {metadata_path}...")
+        meta_table = pq.read_table(str(metadata_path), memory_map=True)
+        n_functions = meta_table.num_rows
+    else:
+        for legacy_path in (Path("./data/codesearchnet/python_metadata.jsonl"),
+                            Path("./data/codesearchnet/python_metadata.json")):
+            if legacy_path.exists():
+                metadata_path = legacy_path
+                break
+        else:
+            print(f"❌ ERROR: Metadata not found at {metadata_path}")
+            print()
+            print("Run re-embedding script first:")
+            print("  python scripts/re_embed_codesearchnet.py")
+            sys.exit(1)
+
+        print(f"📂 Loading metadata from {metadata_path}...")
+        with open(metadata_path, 'r') as f:
+            if metadata_path.suffix == '.jsonl':
+                metadata = [json.loads(line) for line in f]
+            else:
+                metadata = json.load(f)
+        n_functions = len(metadata)
+
+    print(f"✅ Loaded metadata: {n_functions:,} records")
     print()
 
+    def iter_metadata():
+        """Yield metadata dicts one Arrow record batch at a time (no full list)."""
+        if meta_table is not None:
+            for meta_batch in meta_table.to_batches(max_chunksize=10000):
+                for row in meta_batch.to_pylist():
+                    yield row
+        else:
+            for row in metadata:
+                yield row
+
     # Validation
-    assert len(embeddings) == len(metadata), "Embedding/metadata count mismatch"
+    assert len(embeddings) == n_functions, "Embedding/metadata count mismatch"
     print(f"✅ Validation: {len(embeddings):,} functions ready for import")
     print()
 
@@ -147,9 +189,18 @@ def main():
             conn.close()
             sys.exit(0)
 
-    # Prepare insert query
-    insert_query = """
-        INSERT INTO codesearchnet_functions (
+    # Drop the vector index for the duration of the load — every insert otherwise
+    # pays an O(log n) HNSW graph walk, and a single bulk build afterwards batches
+    # the distance computations far more efficiently than 412K point inserts
+    print("🔧 Dropping HNSW index for bulk load...")
+    cursor.execute("DROP INDEX IF EXISTS codesearchnet_functions_embedding_idx;")
+    conn.commit()
+    print("✅ Index dropped (rebuilt after import)")
+    print()
+
+    # COPY target — text format, tab-delimited (pgvector parses '[x,y,...]' text)
+    copy_sql = """
+        COPY codesearchnet_functions (
             function_id,
             function_name,
             repo,
@@ -160,74 +211,187 @@ def main():
             embedding,
             confidence,
             docstring_quality
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s, %s, %s::vector, %s, %s
-        );
+        ) FROM STDIN;
     """
 
-    # Prepare data
-    print("📝 Preparing data for bulk insert...")
-    records = []
-
-    for i in range(len(metadata)):
-        meta = metadata[i]
-        embedding_list = embeddings[i].tolist()
+    def copy_escape(value):
+        """Escape a text field for COPY text format (backslash, tab, newline)."""
+        return (str(value)
+                .replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r'))
+
+    # Docstring quality scores, vectorized — one NumPy pass over the length
+    # columns instead of 412K Python-level if/else + min() + round() dispatches
+    # in the COPY hot path. Same heuristic as before: condition on the stripped
+    # length, score on the raw length.
+    print("📝 Computing docstring quality scores (vectorized)...")
+    if meta_table is not None:
+        import pyarrow.compute as pc
+        doc_col = pc.fill_null(meta_table.column('docstring'), '')
+        lengths = pc.utf8_length(doc_col).to_numpy().astype(np.int64)
+        stripped_lengths = pc.utf8_length(pc.utf8_trim_whitespace(doc_col)).to_numpy().astype(np.int64)
+    else:
+        docs = [(m['docstring'] or '') for m in metadata]
+        lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=len(docs))
+        stripped_lengths = np.fromiter((len(d.strip()) for d in docs), dtype=np.int64, count=len(docs))
+
+    quality_arr = np.round(
+        np.where(stripped_lengths > 20, np.minimum(0.95, 0.5 + lengths / 500.0), 0.3),
+        2
+    )
+    print(f"✅ Quality scores ready ({len(quality_arr):,} rows)")
+    print()
 
-        # Calculate docstring quality score (simple heuristic)
-        docstring = meta['docstring']
-        if docstring and len(docstring.strip()) > 20:
-            docstring_quality = min(0.95, 0.5 + (len(docstring) / 500))
+    # COPY column order for the text fields (embedding/confidence/quality appended
+    # separately in copy_buffer)
+    META_FIELDS = ('function_id', 'function_name', 'repo', 'path',
+                   'language', 'docstring', 'code')
+
+    def iter_meta_range(start, end):
+        """
+        Yield metadata rows [start, end) as tuples in META_FIELDS order.
+
+        Columns are hoisted to Python lists once per record batch and zipped —
+        to_pylist() per row built a dict and copy_buffer then hashed 7 keys per
+        row (~3M dict lookups over the full import). Positional tuples skip all
+        of that on the hot path.
+        """
+        if meta_table is not None:
+            for meta_batch in meta_table.slice(start, end - start).to_batches(max_chunksize=1000):
+                cols = [meta_batch.column(name).to_pylist() for name in META_FIELDS]
+                yield from zip(*cols)
         else:
-            docstring_quality = 0.3
-
-        record = (
-            meta['function_id'],
-            meta['function_name'],
-            meta['repo'],
-            meta['path'],
-            meta['language'],
-            meta['docstring'],
-            meta['code'],
-            embedding_list,  # Will be converted to vector by PostgreSQL
-            0.75,  # Confidence (lower than custom patterns at 0.95)
-            round(docstring_quality, 2)
-        )
-        records.append(record)
-
-    print(f"✅ Prepared {len(records):,} records")
-    print()
+            for row in metadata[start:end]:
+                yield tuple(row[name] for name in META_FIELDS)
 
-    # Batch insert
-    print("🚀 Starting bulk insert...")
+    # Fallback path if the environment rejects COPY (restricted poolers do):
+    # one multi-row INSERT per batch via execute_values — a single parse/plan
+    # per 1,000 rows, still far better than per-row INSERTs
+    insert_sql = """
+        INSERT INTO codesearchnet_functions (
+            function_id, function_name, repo, path, language,
+            docstring, code, embedding, confidence, docstring_quality
+        ) VALUES %s;
+    """
+    insert_template = "(%s,%s,%s,%s,%s,%s,%s,%s::vector,%s,%s)"
+
+    def values_rows(start, meta_rows):
+        """Parameter tuples for the execute_values fallback (same fused prep as copy_buffer)."""
+        return [
+            meta + (
+                '[' + ','.join(map(str, embeddings[start + j].tolist())) + ']',
+                0.75,  # Confidence (lower than custom patterns at 0.95)
+                float(quality_arr[start + j]),
+            )
+            for j, meta in enumerate(meta_rows)
+        ]
+
+    def copy_buffer(start, meta_rows):
+        """
+        Serialize one batch of rows into a COPY text-format buffer.
+
+        Prep and serialization are fused: the embedding text is built here
+        straight from the memmap and the quality score is indexed from the
+        precomputed vector — no intermediate records list ever exists.
+        """
+        buf = io.StringIO()
+        for j, meta in enumerate(meta_rows):
+            embedding_text = '[' + ','.join(map(str, embeddings[start + j].tolist())) + ']'
+            fields = [copy_escape(value) for value in meta]
+            fields.append(embedding_text)
+            fields.append('0.75')  # Confidence (lower than custom patterns at 0.95)
+            fields.append(str(quality_arr[start + j]))
+            buf.write('\t'.join(fields) + '\n')
+        buf.seek(0)
+        return buf
+
+    # Bulk load via COPY, sharded across parallel connections.
+    # Postgres ingest scales with concurrent writers until WAL/IO saturates,
+    # so disjoint row ranges on separate connections give near-linear speedup.
+    num_shards = 8
+    batch_size = 1000
+
+    print("🚀 Starting COPY bulk load...")
     print(f"   Batch size: 1,000 functions/transaction")
-    print(f"   Total batches: {(len(records) + 999) // 1000:,}")
-    print(f"   Estimated time: 1-2 hours")
+    print(f"   Total batches: {(n_functions + 999) // 1000:,}")
+    print(f"   Parallel connections: {num_shards}")
+    print(f"   Estimated time: ~5 minutes")
     print()
 
-    batch_size = 1000
-    total_inserted = 0
+    shard_size = (n_functions + num_shards - 1) // num_shards
+    pbar = tqdm(total=n_functions, desc="Importing", unit="rows")
+
+    def copy_shard(start, end):
+        """COPY rows [start, end) over a dedicated connection (disjoint shard)."""
+        shard_conn = psycopg2.connect(database_url)
+        try:
+            shard_conn.autocommit = False
+            shard_cursor = shard_conn.cursor()
+            # Each commit normally fsyncs WAL (5-20ms on cloud disks — minutes
+            # across the whole load). The bootstrap is re-runnable, so trading
+            # that durability for async WAL flush is free throughput.
+            shard_cursor.execute("SET synchronous_commit = off;")
+            shard_cursor.execute("SET work_mem = '256MB';")
+            inserted = 0
+            use_copy = True
+            rows = iter_meta_range(start, end)
+            i = start
+            while i < end:
+                chunk = list(islice(rows, batch_size))
+                if not chunk:
+                    break
+                if use_copy:
+                    try:
+                        shard_cursor.copy_expert(copy_sql, copy_buffer(i, chunk))
+                    except psycopg2.Error as e:
+                        # Environment refuses COPY — downgrade this shard to
+                        # multi-row INSERTs rather than failing the import
+                        shard_conn.rollback()
+                        use_copy = False
+                        print(f"\n⚠️  COPY rejected ({e}); falling back to execute_values")
+                if not use_copy:
+                    execute_values(shard_cursor, insert_sql, values_rows(i, chunk),
+                                   template=insert_template, page_size=len(chunk))
+                shard_conn.commit()
+                inserted += len(chunk)
+                pbar.update(len(chunk))
+                i += len(chunk)
+            return inserted
+        finally:
+            shard_conn.close()
 
     try:
-        for i in tqdm(range(0, len(records), batch_size), desc="Importing"):
-            batch = records[i:i + batch_size]
-
-            # Batch insert
-            execute_batch(cursor, insert_query, batch, page_size=batch_size)
-            conn.commit()
-
-            total_inserted += len(batch)
-
-            # Progress checkpoint every 50,000 functions
-            if total_inserted % 50000 == 0:
-                cursor.execute("SELECT COUNT(*) FROM codesearchnet_functions;")
-                current_count = cursor.fetchone()[0]
-                print(f"\n   Checkpoint: {current_count:,} functions inserted")
+        with ThreadPoolExecutor(max_workers=num_shards) as executor:
+            shard_totals = list(executor.map(
+                copy_shard,
+                range(0, n_functions, shard_size),
+                [min(s + shard_size, n_functions) for s in range(0, n_functions, shard_size)]
+            ))
+        pbar.close()
+        total_inserted = sum(shard_totals)
 
         print()
         print(f"✅ Bulk insert complete: {total_inserted:,} functions")
         print()
 
+        # Rebuild the vector index in one bulk pass (parallel HNSW build)
+        print("🔧 Rebuilding HNSW index (bulk build)...")
+        cursor.execute("SET maintenance_work_mem = '2GB';")
+        cursor.execute("SET max_parallel_maintenance_workers = 8;")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS codesearchnet_functions_embedding_idx
+            ON codesearchnet_functions
+            USING hnsw (embedding vector_cosine_ops)
+            WITH (m = 16, ef_construction = 64);
+        """)
+        conn.commit()
+        print("✅ HNSW index rebuilt")
+        print()
+
     except Exception as e:
+        pbar.close()
         print(f"\n❌ ERROR: Import failed")
         print(f"Error: {str(e)}")
         conn.rollback()
@@ -261,9 +425,9 @@ def main():
 
     print()
 
-    assert final_count == len(metadata), f"Count mismatch: {final_count} != {len(metadata)}"
-    assert embedded_count == len(metadata), f"Embedding count mismatch: {embedded_count} != {len(metadata)}"
-    assert indexed_count == len(metadata), f"Index count mismatch: {indexed_count} != {len(metadata)}"
+    assert final_count == n_functions, f"Count mismatch: {final_count} != {n_functions}"
+    assert embedded_count == n_functions, f"Embedding count mismatch: {embedded_count} != {n_functions}"
+    assert indexed_count == n_functions, f"Index count mismatch: {indexed_count} != {n_functions}"
 
     print("✅ All validation checks passed")
     print()
@@ -7,23 +7,51 @@ WHY: Original CodeSearchNet embeddings are from CodeBERT (older model), Voyage-c
 
 REASONING CHAIN:
 1. Load CodeSearchNet dataset from disk (412K functions)
-2. Batch embed with Voyage-code-2 (128 functions/batch for speed)
-3. Save embeddings to disk (numpy array: 412,178 × 1024)
-4. Validate: All functions embedded, no errors
-5. Result: Ready for Day 3 import to Supabase
+2. Stream batches straight off the Arrow dataset (zero-copy slices, no giant lists)
+3. Batch embed with Voyage-code-2 (128 functions/batch for speed)
+4. Write embeddings into a pre-allocated memmap (412,178 × 1024) as batches complete
+5. Stream metadata to python_metadata.parquet (zstd, 10K-row groups)
+6. Validate: All functions embedded, no errors
+7. Result: Ready for Day 3 import to Supabase
 
 PATTERN: Pattern-BOOTSTRAP-001 (CodeSearchNet Bootstrap)
-PERFORMANCE: ~4 hours for 412K functions (batch API)
+PERFORMANCE: ~30-45 min for 412K functions (8 concurrent requests, was ~4 hours sequential)
 COST: $12.36 (206M tokens × $0.06/1M)
+
+FIX (2025-10-17): Embedding loop is network-bound, not CPU-bound. Replaced the
+sequential request + sleep(0.6) loop with a ThreadPoolExecutor keeping 8 requests
+in flight behind a shared 100 req/min pacer. Results are written by batch index
+so ordering is preserved.
+
+FIX (2025-10-17): Stopped materializing `texts` and `metadata` lists (412K entries,
+hundreds of MB duplicating strings already in the Arrow dataset). Batches now
+stream from zero-copy dataset slices, metadata goes to JSONL one line at a time,
+and embeddings land in a pre-sized np.memmap — peak RSS stays flat for the whole run.
+
+FIX (2025-10-17): Metadata format JSONL → Parquet (zstd). json.load on the import
+side built 412K Python dicts (~GBs of interned strings); Parquet is columnar,
+compressed, and memory-mappable so the importer streams record batches instead.
+
+FIX (2025-10-17): Dropped the fixed 0.6s dispatch spacing. It was a conservative
+floor that wasted capacity whenever the real limit allowed more, and it kept
+sleeping even when response latency already ate the budget. Workers now dispatch
+freely and back off only when the API's x-ratelimit-* headers say the quota is
+exhausted (urllib3 Retry still covers any 429 that slips through).
+
+FIX (2025-10-17): Crash resilience. A failure at hour 3.5 used to lose the whole
+run (and the API spend). The memmap is now reopened in place on rerun and a
+checkpoint file records the contiguous completed row count — completed batches
+are skipped, only their metadata is regenerated locally.
 """
 
 import os
 import sys
 import time
+import threading
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tqdm import tqdm
-import json
 
 def main():
     print("=" * 80)
@@ -46,168 +74,328 @@ def main():
     # Check dependencies
     try:
         import requests
-        from datasets import load_from_disk
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from datasets import load_dataset, load_from_disk
     except ImportError as e:
         print(f"❌ ERROR: Missing dependency: {e}")
         print()
         print("Install with:")
-        print("  pip install requests datasets tqdm numpy")
-        sys.exit(1)
-
-    # Load dataset
-    data_dir = Path("./data/codesearchnet/python_train")
-    if not data_dir.exists():
-        print(f"❌ ERROR: Dataset not found at {data_dir}")
-        print()
-        print("Run download script first:")
-        print("  python scripts/download_codesearchnet.py")
+        print("  pip install requests datasets tqdm numpy pyarrow")
         sys.exit(1)
 
-    print(f"📂 Loading dataset from {data_dir}...")
-    dataset = load_from_disk(str(data_dir))
+    # Shared HTTP session: keep-alive avoids a fresh TCP+TLS handshake (~100ms)
+    # on every one of ~3,200 calls, and urllib3 Retry replaces the hand-rolled
+    # sleep-and-retry block with exponential backoff on transient API errors
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['POST'],
+        ),
+    ))
+
+    # orjson parses the numeric-heavy embedding payloads (~0.5 MB of floats per
+    # batch) roughly 3× faster than stdlib json. Optional: stdlib is a drop-in
+    # fallback, no hard dependency added.
+    try:
+        import orjson
+        json_loads = orjson.loads
+    except ImportError:
+        import json
+        json_loads = json.loads
+
+    # Load dataset — legacy save_to_disk copy if one exists, otherwise straight
+    # from the HF cache the download script populated (no duplicate on disk)
+    data_dir = Path("./data/codesearchnet")
+    legacy_dir = data_dir / "python_train"
+    if legacy_dir.exists():
+        print(f"📂 Loading dataset from {legacy_dir}...")
+        dataset = load_from_disk(str(legacy_dir))
+    else:
+        print(f"📂 Loading dataset from HF cache under {data_dir}...")
+        try:
+            dataset = load_dataset(
+                'code_search_net',
+                'python',
+                split='train',
+                cache_dir=str(data_dir)
+            )
+        except Exception as e:
+            print(f"❌ ERROR: Dataset not available ({e})")
+            print()
+            print("Run download script first:")
+            print("  python scripts/download_codesearchnet.py")
+            sys.exit(1)
     print(f"✅ Loaded {len(dataset):,} functions")
     print()
 
-    # Prepare texts for embedding
-    print("📝 Preparing texts for embedding...")
-    texts = []
-    metadata = []
-
-    for idx, item in enumerate(tqdm(dataset, desc="Preparing")):
-        # Combine docstring + code for better embeddings
-        docstring = item['func_documentation_string'] or ''
-        code = item['func_code_string'] or ''
-
-        # Format: "docstring\n\ncode" (up to 8K tokens per Voyage limits)
-        text = f"{docstring}\n\n{code}"[:30000]  # ~8K tokens max
-        texts.append(text)
-
-        # Save metadata for later import
-        metadata.append({
-            'function_id': f"csn-python-{idx}",
-            'function_name': item['func_name'],
-            'repo': item['repo_name'],
-            'path': item['path'],
-            'language': 'Python',
-            'docstring': docstring,
-            'code': code,
-        })
-
-    print(f"✅ Prepared {len(texts):,} texts for embedding")
-    print()
-
     # Batch embedding with Voyage AI
+    # Texts/metadata stream per-batch from Arrow slices — nothing is materialized up front
+    total = len(dataset)
+    batch_size = 128
+    total_batches = (total + batch_size - 1) // batch_size
+
     print("🚀 Starting batch embedding with Voyage-code-2...")
     print(f"   Model: voyage-code-2 (code-optimized, 1024-dim)")
     print(f"   Batch size: 128 functions/batch")
-    print(f"   Total batches: {(len(texts) + 127) // 128:,}")
-    print(f"   Estimated time: ~4 hours")
+    print(f"   Total batches: {total_batches:,}")
+    print(f"   Concurrency: 8 requests in flight")
+    print(f"   Estimated time: ~30-45 minutes")
     print(f"   Estimated cost: $12.36")
     print()
 
-    embeddings = []
-    batch_size = 128
-    total_batches = (len(texts) + batch_size - 1) // batch_size
-
-    start_time = time.time()
-
-    for i in tqdm(range(0, len(texts), batch_size), desc="Embedding", total=total_batches):
-        batch = texts[i:i + batch_size]
-
-        # Call Voyage API
-        try:
-            response = requests.post(
-                'https://api.voyageai.com/v1/embeddings',
-                headers={
-                    'Authorization': f'Bearer {voyage_api_key}',
-                    'Content-Type': 'application/json',
-                },
-                json={
-                    'model': 'voyage-code-2',  # Code-optimized model
-                    'input': batch,
-                    'input_type': 'document',  # Document mode for indexing
-                },
-                timeout=120
+    def iter_batches(ds, bs):
+        """Yield (start_index, dict-of-columns) zero-copy slices from the Arrow dataset."""
+        for i in range(0, len(ds), bs):
+            yield i, ds[i:i + bs]
+
+    def prepare_batch(rows):
+        """Combine docstring + code per row: 'docstring\\n\\ncode' (~8K tokens max)."""
+        batch = []
+        for docstring, code in zip(rows['func_documentation_string'], rows['func_code_string']):
+            docstring = docstring or ''
+            code = code or ''
+            batch.append(f"{docstring}\n\n{code}"[:30000])
+        return batch
+
+    # Pre-allocate the output as a memmap — batches write their slice as they complete.
+    # On rerun, reopen in place and resume from the checkpointed contiguous row count
+    # so an interrupted run only re-embeds what it has to.
+    embeddings_path = Path("./data/codesearchnet/python_embeddings.npy")
+    checkpoint_path = Path("./data/codesearchnet/python_embeddings.checkpoint")
+
+    resume_offset = 0
+    if embeddings_path.exists() and checkpoint_path.exists():
+        emb_mm = np.lib.format.open_memmap(str(embeddings_path), mode='r+')
+        if emb_mm.shape == (total, 1024):
+            resume_offset = int(checkpoint_path.read_text().strip() or 0)
+            print(f"🔄 Resuming: {resume_offset:,}/{total:,} rows already embedded")
+            print()
+        else:
+            print(f"⚠️  Existing embeddings shape {emb_mm.shape} doesn't match dataset, starting over")
+            emb_mm = np.lib.format.open_memmap(
+                str(embeddings_path), mode='w+', dtype=np.float32, shape=(total, 1024)
             )
-
-            if response.status_code != 200:
-                print(f"\n❌ ERROR: Voyage API returned {response.status_code}")
-                print(f"Response: {response.text}")
-                sys.exit(1)
-
-            data = response.json()
-            batch_embeddings = [item['embedding'] for item in data['data']]
-            embeddings.extend(batch_embeddings)
-
+    else:
+        emb_mm = np.lib.format.open_memmap(
+            str(embeddings_path), mode='w+', dtype=np.float32, shape=(total, 1024)
+        )
+
+    # Metadata streams to Parquet — columnar + zstd, written in 10K-row groups
+    # so the importer can memory-map it instead of json.load-ing 412K dicts
+    metadata_path = Path("./data/codesearchnet/python_metadata.parquet")
+    meta_writer = None
+    meta_buffer = []
+    META_ROW_GROUP = 10000
+
+    def write_meta_rows(rows):
+        """Append rows to the Parquet writer as one row group."""
+        table = pa.Table.from_pylist(rows)
+        writer = meta_writer or pq.ParquetWriter(str(metadata_path), table.schema, compression='zstd')
+        writer.write_table(table)
+        return writer
+    max_workers = 8  # In-flight requests (I/O-bound: concurrency overlaps HTTP round-trips)
+
+    # Header-driven throttle shared by all workers: dispatch freely until the
+    # API reports the quota is spent, then everyone holds until it resets.
+    # Sleeps only when actually throttled — no fixed per-request spacing.
+    throttle_lock = threading.Lock()
+    throttle_until = [0.0]
+
+    def acquire_rate_slot():
+        """Block while the API-reported rate window is exhausted; otherwise dispatch now."""
+        while True:
+            with throttle_lock:
+                hold = throttle_until[0] - time.time()
+            if hold <= 0:
+                return
+            time.sleep(hold)
+
+    def note_rate_headers(headers):
+        """Arm the shared throttle from Voyage's x-ratelimit-* response headers."""
+        remaining = headers.get('x-ratelimit-remaining')
+        if remaining is None or int(float(remaining)) > 0:
+            return
+        reset = headers.get('x-ratelimit-reset')
+        try:
+            reset = float(reset)
+            # Header may be seconds-until-reset or an epoch timestamp
+            resume_at = reset if reset > 1e9 else time.time() + reset
+        except (TypeError, ValueError):
+            resume_at = time.time() + 1.0
+        with throttle_lock:
+            throttle_until[0] = max(throttle_until[0], resume_at)
+
+    def post_embeddings(batch, timeout):
+        """Single POST to Voyage /v1/embeddings (rate-limited dispatch, pooled session)."""
+        acquire_rate_slot()
+        return session.post(
+            'https://api.voyageai.com/v1/embeddings',
+            headers={
+                'Authorization': f'Bearer {voyage_api_key}',
+                'Content-Type': 'application/json',
+            },
+            json={
+                'model': 'voyage-code-2',  # Code-optimized model
+                'input': batch,
+                'input_type': 'document',  # Document mode for indexing
+            },
+            timeout=timeout
+        )
+
+    def embed_batch(batch, start):
+        """Embed one batch and write its slice of the memmap; returns row count."""
+        try:
+            response = post_embeddings(batch, timeout=120)
         except requests.exceptions.Timeout:
-            print(f"\n⚠️  Timeout on batch {i // batch_size + 1}, retrying...")
-            time.sleep(5)
-            # Retry once
-            response = requests.post(
-                'https://api.voyageai.com/v1/embeddings',
-                headers={
-                    'Authorization': f'Bearer {voyage_api_key}',
-                    'Content-Type': 'application/json',
-                },
-                json={
-                    'model': 'voyage-code-2',
-                    'input': batch,
-                    'input_type': 'document',
-                },
-                timeout=180
-            )
-            data = response.json()
-            batch_embeddings = [item['embedding'] for item in data['data']]
-            embeddings.extend(batch_embeddings)
-
+            # Adapter retries cover status errors; one manual retry for timeouts
+            print(f"\n⚠️  Timeout on batch {start // batch_size + 1}, retrying...")
+            response = post_embeddings(batch, timeout=180)
+
+        note_rate_headers(response.headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"Voyage API returned {response.status_code}: {response.text}")
+
+        data = json_loads(response.content)
+        batch_embeddings = [item['embedding'] for item in data['data']]
+
+        # Index write preserves dataset order regardless of completion order
+        emb_mm[start:start + len(batch_embeddings)] = np.asarray(batch_embeddings, dtype=np.float32)
+
+        # Voyage reports exact token usage per request — no client-side estimate needed
+        usage_tokens = data.get('usage', {}).get('total_tokens', 0)
+        advance_checkpoint(start, len(batch_embeddings))
+        return len(batch_embeddings), usage_tokens
+
+    # Checkpoint = highest CONTIGUOUS completed row. Batches finish out of order,
+    # so completed slices park in a dict until the watermark reaches them; every
+    # ~100 batches the memmap is flushed and the watermark written atomically.
+    ckpt_lock = threading.Lock()
+    watermark = [resume_offset]
+    parked = {}
+    last_persisted = [resume_offset]
+    CHECKPOINT_ROWS = 100 * batch_size
+
+    def advance_checkpoint(start, count):
+        """Advance the contiguous-completion watermark and persist it periodically."""
+        with ckpt_lock:
+            parked[start] = count
+            while watermark[0] in parked:
+                watermark[0] += parked.pop(watermark[0])
+            if watermark[0] - last_persisted[0] >= CHECKPOINT_ROWS:
+                emb_mm.flush()
+                tmp = checkpoint_path.with_suffix('.checkpoint.tmp')
+                tmp.write_text(str(watermark[0]))
+                tmp.replace(checkpoint_path)
+                last_persisted[0] = watermark[0]
+
+    def collect(future, futures):
+        """Surface worker errors; returns (embedded row count, usage tokens)."""
+        try:
+            return future.result()
         except Exception as e:
-            print(f"\n❌ ERROR: Failed on batch {i // batch_size + 1}")
+            print(f"\n❌ ERROR: Failed on batch {futures[future] + 1}")
             print(f"Error: {str(e)}")
             sys.exit(1)
 
-        # Rate limiting: 100 requests/minute for Voyage AI
-        time.sleep(0.6)  # ~100 req/min
-
+    start_time = time.time()
+    total_embedded = resume_offset  # Rows completed by a previous (interrupted) run
+    total_tokens = 0  # Exact usage accumulated from API responses
+
+    # Windowed submission: prep runs on the main thread while workers embed,
+    # and only ~2× max_workers batches of text are alive at any moment.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+         tqdm(total=total_batches, desc="Embedding") as pbar:
+
+        futures = {}
+        pending = set()
+
+        for start, rows in iter_batches(dataset, batch_size):
+            batch = prepare_batch(rows)
+
+            # Stream metadata for later import (buffered into Parquet row groups)
+            for offset in range(len(batch)):
+                meta_buffer.append({
+                    'function_id': f"csn-python-{start + offset}",
+                    'function_name': rows['func_name'][offset],
+                    'repo': rows['repo_name'][offset],
+                    'path': rows['path'][offset],
+                    'language': 'Python',
+                    'docstring': rows['func_documentation_string'][offset] or '',
+                    'code': rows['func_code_string'][offset] or '',
+                })
+            if len(meta_buffer) >= META_ROW_GROUP:
+                meta_writer = write_meta_rows(meta_buffer)
+                meta_buffer = []
+
+            # Already embedded by a previous run — metadata regenerated above, no API call
+            if start + len(batch) <= resume_offset:
+                pbar.update(1)
+                continue
+
+            future = executor.submit(embed_batch, batch, start)
+            futures[future] = start // batch_size
+            pending.add(future)
+
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count, usage = collect(future, futures)
+                    total_embedded += count
+                    total_tokens += usage
+                    pbar.update(1)
+
+        for future in as_completed(pending):
+            count, usage = collect(future, futures)
+            total_embedded += count
+            total_tokens += usage
+            pbar.update(1)
+
+    if meta_buffer:
+        meta_writer = write_meta_rows(meta_buffer)
+        meta_buffer = []
+    if meta_writer is not None:
+        meta_writer.close()
+
+    emb_mm.flush()
+    checkpoint_path.write_text(str(total))
     elapsed_time = time.time() - start_time
     print()
     print(f"✅ Embedding complete in {elapsed_time / 3600:.2f} hours")
     print()
 
-    # Convert to numpy array
-    print("💾 Saving embeddings to disk...")
-    embeddings_array = np.array(embeddings, dtype=np.float32)
-
-    # Save embeddings
-    embeddings_path = Path("./data/codesearchnet/python_embeddings.npy")
-    np.save(embeddings_path, embeddings_array)
+    # Embeddings already on disk via the memmap — just report
     print(f"✅ Embeddings saved: {embeddings_path}")
-    print(f"   Shape: {embeddings_array.shape} (412,178 × 1024)")
+    print(f"   Shape: {emb_mm.shape} (412,178 × 1024)")
     print(f"   Size: {embeddings_path.stat().st_size / 1024 / 1024:.1f} MB")
     print()
 
-    # Save metadata
-    metadata_path = Path("./data/codesearchnet/python_metadata.json")
-    with open(metadata_path, 'w') as f:
-        json.dump(metadata, f)
     print(f"✅ Metadata saved: {metadata_path}")
-    print(f"   Records: {len(metadata):,}")
+    print(f"   Records: {total_embedded:,}")
     print()
 
     # Validation
     print("=" * 80)
     print("Validation")
     print("=" * 80)
-    assert len(embeddings) == len(texts), "Embedding count mismatch"
-    assert embeddings_array.shape == (len(texts), 1024), "Embedding shape mismatch"
-    print(f"✅ All {len(embeddings):,} functions embedded successfully")
+    assert total_embedded == total, "Embedding count mismatch"
+    assert emb_mm.shape == (total, 1024), "Embedding shape mismatch"
+    print(f"✅ All {total_embedded:,} functions embedded successfully")
     print(f"✅ Embedding dimensions: 1024 (Voyage-code-2)")
     print()
 
-    # Cost calculation
-    total_tokens = sum(len(text.split()) * 1.3 for text in texts)  # Rough estimate
+    # Cost calculation — exact usage from the API, no O(N) re-scan of the texts
     cost = (total_tokens / 1_000_000) * 0.06  # $0.06 per 1M tokens
-    print(f"📊 Estimated cost: ${cost:.2f}")
-    print(f"   Total tokens: ~{total_tokens / 1_000_000:.1f}M")
+    print(f"📊 Actual cost: ${cost:.2f}")
+    print(f"   Total tokens: {total_tokens / 1_000_000:.1f}M")
     print(f"   Rate: $0.06 per 1M tokens")
     print()
 
@@ -219,7 +407,7 @@ def main():
     print()
     print("This will:")
     print("  1. Load embeddings from python_embeddings.npy")
-    print("  2. Load metadata from python_metadata.json")
+    print("  2. Load metadata from python_metadata.parquet")
     print("  3. Bulk insert 412K functions into codesearchnet_functions table")
     print("  4. Verify: 412,178 searchable functions ready")
     print()
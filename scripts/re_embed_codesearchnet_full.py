@@ -9,21 +9,37 @@ REASONING CHAIN:
 1. Load all 18 datasets from disk (6 languages × 3 splits)
 2. Batch embed with Voyage-code-3 (32 functions/batch to stay under 120K token limit)
 3. Adaptive text truncation: 15K-30K chars based on function length
-4. Save embeddings per dataset (e.g., python_train_embeddings.npy)
+4. Save one memmap per language (e.g., python_all_embeddings.npy + offsets)
 5. Validate: All functions embedded, no errors
 6. Result: Ready for Day 3 import to Supabase (2M searchable functions)
 
 PATTERN: Pattern-BOOTSTRAP-003 (Full Multi-Language Bootstrap)
-PERFORMANCE: ~36-50 hours for 2M functions (batch API, rate limited, safer batch size)
+PERFORMANCE: ~6-8 hours for 2M functions (async pipeline, 10 batches in flight; was 36-50 serial)
 COST: ~$24 (2M functions × ~1K tokens × $0.012 per 1K tokens)
 
 FIX (2025-10-16): Reduced batch size 64→32 and added adaptive truncation after
 batch 298 token limit error (126,602 tokens exceeded 120K limit)
+
+FIX (2025-10-17): Sync requests.post loop → asyncio + aiohttp. Each blocking
+round-trip (~1-3s) left the CPU idle; with 10 batches in flight behind one
+keep-alive session the wall time is bounded by the rate limit, not latency.
+Results land in a preallocated array indexed by batch offset, so completion
+order doesn't matter.
+
+NOTE on the voyageai SDK: the hand-rolled aiohttp client stays deliberate.
+The SDK's built-in retry/backoff would fight the shared header-calibrated
+TokenBucket (two pacers, one budget), and it exposes neither the raw
+x-ratelimit-* headers the bucket recalibrates from nor the base64 float32
+transport the parser relies on. The ~60 lines of retry code here ARE the
+rate-limit strategy, not an accident.
 """
 
 import os
 import sys
 import time
+import base64
+import hashlib
+import asyncio
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
@@ -41,119 +57,560 @@ LANGUAGES = {
 
 SPLITS = ['train', 'validation', 'test']
 
-def embed_dataset(dataset_path, output_path, voyage_api_key, lang_name, split_name):
+# JSON fast path: each response carries batch_size x 1024 floats, and orjson
+# parses numeric-heavy payloads 3-5x faster than stdlib json. Optional —
+# stdlib is a drop-in fallback, no hard dependency added.
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    import json as _stdlib_json
+
+    def _json_dumps(obj):
+        return _stdlib_json.dumps(obj).encode()
+
+    _json_loads = _stdlib_json.loads
+
+
+# Token counting for batch packing: tiktoken's cl100k_base is close enough to
+# Voyage's tokenizer for budgeting. Optional — the chars/4 heuristic keeps the
+# script dependency-light when tiktoken isn't installed.
+try:
+    import tiktoken
+    _ENCODER = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _ENCODER = None
+
+TOKEN_BUDGET = 110_000   # Per-request packing target (Voyage hard limit: 120K)
+MAX_BATCH_ITEMS = 1000   # Voyage per-request item cap
+MAX_DOC_TOKENS = 8_000   # Per-document cap before exact truncation
+
+class TokenBucket:
     """
-    Embed a single dataset split and save embeddings.
+    Adaptive request pacer recalibrated from the API's rate-limit headers.
 
-    Args:
-        dataset_path: Path to dataset directory
-        output_path: Path to save embeddings (.npy)
-        voyage_api_key: Voyage API key
-        lang_name: Language name (for progress display)
-        split_name: Split name (train/validation/test)
+    Starts at the documented 100 req/min and then trusts what Voyage reports:
+    tokens are clamped to x-ratelimit-remaining after each response, and a
+    reported exhaustion (or an explicit Retry-After on 429) holds ALL
+    dispatches until the window resets. Sleeps only when actually throttled —
+    no fixed 0.6s spacing and no blind 10s backoffs.
+    """
+
+    def __init__(self, rate_per_minute=100):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.refill_rate = rate_per_minute / 60.0  # tokens per second
+        self.last_update = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = None  # Created lazily inside the running event loop
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.refill_rate)
+        self.last_update = now
+
+    async def acquire(self):
+        """Take one dispatch token, sleeping only while the bucket is empty or held."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        while True:
+            async with self._lock:
+                hold = self.blocked_until - time.monotonic()
+                if hold <= 0:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    hold = (1 - self.tokens) / self.refill_rate
+            await asyncio.sleep(hold)
+
+    def observe(self, headers):
+        """Recalibrate from x-ratelimit-* headers on a successful response."""
+        remaining = (headers.get('x-ratelimit-remaining-requests')
+                     or headers.get('x-ratelimit-remaining'))
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0:
+            reset = (headers.get('x-ratelimit-reset-requests')
+                     or headers.get('x-ratelimit-reset'))
+            try:
+                reset_s = float(reset)
+            except (TypeError, ValueError):
+                reset_s = 1.0
+            if reset_s > 1e9:  # Epoch timestamp rather than seconds-until
+                reset_s = max(0.0, reset_s - time.time())
+            self.blocked_until = max(self.blocked_until, time.monotonic() + reset_s)
+
+    def penalize(self, retry_after):
+        """Server said 429: hold all dispatches for exactly Retry-After seconds."""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = 1.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+def load_split(dataset_path):
+    """
+    Load a downloaded split: Parquet shard (streaming download script) preferred,
+    save_to_disk Arrow directory (legacy downloads) as fallback.
+    """
+    from datasets import Dataset, load_from_disk
+
+    parquet_path = dataset_path.with_suffix('.parquet')
+    if parquet_path.exists():
+        return Dataset.from_parquet(str(parquet_path))
+    return load_from_disk(str(dataset_path))
+
+def split_exists(dataset_path):
+    """True if either the Parquet shard or the legacy Arrow directory is present."""
+    return dataset_path.with_suffix('.parquet').exists() or dataset_path.exists()
+
+def make_text_chars(docstring, code):
+    """
+    Character-ladder stage of text prep: a coarse pre-clip before tokenizing.
+
+    Very long functions: 15K chars (~4K tokens)
+    Long functions: 20K chars (~5K tokens)
+    Normal functions: 30K chars (~8K tokens)
+    """
+    combined = f"{docstring or ''}\n\n{code or ''}"
+    if len(combined) > 50000:
+        return combined[:15000]  # Extra long → 15K chars
+    if len(combined) > 30000:
+        return combined[:20000]  # Long → 20K chars
+    return combined[:30000]  # Normal → 30K chars
+
+def prep_batch(batch):
+    """
+    datasets.map worker: build the embed text and its token length per row.
+
+    Module-level so num_proc workers can pickle it.
+    """
+    texts = [make_text_chars(d, c) for d, c in
+             zip(batch['func_documentation_string'], batch['func_code_string'])]
+    if _ENCODER is not None:
+        # One tokenizer pass per map batch: encode_batch (C threads) yields
+        # both the exact MAX_DOC_TOKENS clip and the tok_len column, instead
+        # of encoding every text twice through make_text + token_len
+        tok_lens = []
+        for j, ids in enumerate(_ENCODER.encode_batch(texts, disallowed_special=())):
+            if len(ids) > MAX_DOC_TOKENS:
+                texts[j] = _ENCODER.decode(ids[:MAX_DOC_TOKENS])
+                tok_lens.append(MAX_DOC_TOKENS)
+            else:
+                tok_lens.append(len(ids))
+    else:
+        tok_lens = [len(t) // 4 + 1 for t in texts]
+    return {
+        'text': texts,
+        'tok_len': tok_lens,
+        'text_hash': [hashlib.blake2b(t.encode(), digest_size=16).digest() for t in texts],
+    }
+
+def prepare_texts(dataset):
+    """
+    Run text preparation as an Arrow-native map instead of a Python for-loop.
+
+    The per-row loop burned 30s-2min of pure Python per split before the first
+    API call; map(batched=True, num_proc=4) does the concat+truncate across
+    processes and the 'text' column stays Arrow-backed on disk, not a list.
+    Downstream access stays columnar too: length_order reads 'tok_len' as one
+    numpy array and iter_text_batches slices 'text' 1,000 rows at a time —
+    nothing ever iterates the dataset row by row (each dataset[i] pays an
+    Arrow→dict conversion, ~10 µs/row × 500K rows ≈ 5s of pure overhead).
+    """
+    return dataset.map(
+        prep_batch,
+        batched=True,
+        batch_size=10_000,
+        num_proc=4,
+        remove_columns=dataset.column_names,
+    )
+
+def length_order(dataset):
+    """
+    Stable row ordering by token length (from the prepared 'tok_len' column).
+
+    Packing like-sized texts together removes packer fragmentation — a single
+    long text mid-stream no longer ends a batch early — and evens out request
+    latencies. The ordering is deterministic, which the resume watermark
+    relies on.
+    """
+    return np.argsort(np.asarray(dataset['tok_len'], dtype=np.int64), kind='stable')
+
+def iter_text_batches(dataset, max_items=MAX_BATCH_ITEMS):
+    """
+    Yield (offset, texts) batches packed greedily to the token budget.
+
+    A fixed batch size had to assume worst-case lengths (32 items), wasting
+    ~90% of the 120K-token request window on typical short functions. Packing
+    to TOKEN_BUDGET keeps requests full regardless of text length. Texts come
+    off the prepared Arrow 'text' column in zero-copy slices — only one
+    window of strings is alive at a time.
+    """
+    start = 0
+    batch = []
+    budget = 0
+    for i in range(0, len(dataset), 1000):
+        rows = dataset[i:i + 1000]
+        for text, tokens in zip(rows['text'], rows['tok_len']):
+            if batch and (budget + tokens > TOKEN_BUDGET or len(batch) >= max_items):
+                yield start, batch
+                start += len(batch)
+                batch = []
+                budget = 0
+            batch.append(text)
+            budget += tokens
+    if batch:
+        yield start, batch
+
+async def warm_pool(session, n=8):
+    """
+    Pre-warm DNS + TLS on n pooled connections before the first batch.
+
+    Best-effort: each HEAD completes the handshake and parks a hot keep-alive
+    connection (plus a TLS session ticket) in the pool, so no embed request
+    pays connect latency on the critical path. Errors are ignored — a failed
+    warm-up just means that handshake happens on first use instead.
+    """
+    import aiohttp
+
+    async def one():
+        try:
+            async with session.head('https://api.voyageai.com/v1/embeddings',
+                                    timeout=aiohttp.ClientTimeout(total=10)):
+                pass
+        except Exception:
+            pass
+
+    await asyncio.gather(*[one() for _ in range(n)])
+
+async def embed_language(lang_name, voyage_api_key, data_dir, session, bucket):
     """
-    import requests
-    from datasets import load_from_disk
-
-    # Load dataset
-    print(f"   Loading {dataset_path.name}...")
-    dataset = load_from_disk(str(dataset_path))
-    print(f"   Loaded {len(dataset):,} functions")
-
-    # Prepare texts for embedding
-    print(f"   Preparing texts...")
-    texts = []
-    for item in dataset:
-        # Combine docstring + code for better embeddings
-        docstring = item.get('func_documentation_string', '') or ''
-        code = item.get('func_code_string', '') or ''
-
-        # FIXED: Adaptive truncation based on length
-        # Very long functions: 15K chars (~4K tokens)
-        # Medium functions: 20K chars (~5K tokens)
-        # Short functions: 30K chars (~8K tokens)
-        combined = f"{docstring}\n\n{code}"
-        if len(combined) > 50000:
-            text = combined[:15000]  # Extra long → 15K chars
-        elif len(combined) > 30000:
-            text = combined[:20000]  # Long → 20K chars
+    Embed all splits of one language as a single concatenated job.
+
+    Per-split jobs left two pipeline "tails" per language: the last few
+    hundred items of validation and test trickled through with the request
+    window underfed. Concatenating train+validation+test keeps one large job
+    saturated end to end. The combined {lang}_all_embeddings.npy memmap is
+    the final artifact; a {lang}_offsets.json sidecar maps each split to its
+    [start, end) row range and readers take zero-copy views of the one
+    mapped array instead of loading per-split files.
+    """
+    from datasets import concatenate_datasets
+
+    present = []
+    for split_name in SPLITS:
+        dataset_path = data_dir / f"{lang_name}_{split_name}"
+        if split_exists(dataset_path):
+            present.append((split_name, dataset_path))
         else:
-            text = combined[:30000]  # Normal → 30K chars
+            print(f"   WARNING: Dataset not found: {dataset_path.name}, skipping...")
+    if not present:
+        print()
+        return 0
+
+    combined_path = data_dir / f"{lang_name}_all_embeddings.npy"
+    offsets_path = data_dir / f"{lang_name}_offsets.json"
+    progress_path = Path(str(combined_path) + '.progress')
+    if (combined_path.exists() and offsets_path.exists()
+            and not progress_path.exists()):
+        print(f"   Embeddings already exist: {combined_path.name}, skipping...")
+        print()
+        return 0
+
+    print(f"   Loading {len(present)} split(s)...")
+    parts = [load_split(path).select_columns(
+        ['func_documentation_string', 'func_code_string']) for _, path in present]
+    lens = [len(part) for part in parts]
+    combined = concatenate_datasets(parts) if len(parts) > 1 else parts[0]
+
+    count = await embed_dataset(combined, combined_path, voyage_api_key,
+                                lang_name, 'all', session, bucket)
+
+    # The combined memmap IS the final artifact: slicing it back into three
+    # per-split .npy files would copy ~2x the language's bytes for nothing.
+    # An offsets sidecar records each split's [start, end) row range, and
+    # downstream readers take zero-copy views of the one mapped array:
+    #   mm = np.load(f'{lang}_all_embeddings.npy', mmap_mode='r')
+    #   train = mm[start:end]
+    offsets = {}
+    offset = 0
+    for (split_name, _), n in zip(present, lens):
+        offsets[split_name] = [offset, offset + n]
+        offset += n
+    offsets_path.write_bytes(_json_dumps(offsets))
+    print(f"   Saved {combined_path.name}: {offset:,} rows (+ {offsets_path.name})")
+    print()
+    return count
 
-        texts.append(text)
+async def run_all(voyage_api_key, data_dir):
+    """
+    Embed every language × split over ONE keep-alive session and token bucket.
 
-    print(f"   Prepared {len(texts):,} texts")
+    A session per split re-did the TLS handshake and warmed a fresh connection
+    pool 18 times; sharing one session (and one header-calibrated bucket)
+    across the whole run makes every request after the first reuse a hot
+    connection.
+    """
+    import aiohttp
 
-    # Batch embedding with Voyage AI
-    print(f"   Starting batch embedding...")
-    embeddings = []
-    batch_size = 32  # FIXED: Reduced from 64 to 32 (50% reduction for safety)
-    total_batches = (len(texts) + batch_size - 1) // batch_size
+    # ttl_dns_cache holds resolved addresses for 10 min (default 10s) so
+    # reconnects after idle drops skip the resolver round-trip
+    connector = aiohttp.TCPConnector(limit=16, keepalive_timeout=120,
+                                     ttl_dns_cache=600)
+    bucket = TokenBucket(rate_per_minute=100)
+    total_embedded = 0
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await warm_pool(session)
+        for lang_name in LANGUAGES.keys():
+            print("=" * 80)
+            print(f"Embedding {lang_name.upper()} (all splits)")
+            print("=" * 80)
+            print()
 
-    for i in tqdm(range(0, len(texts), batch_size), desc=f"   {lang_name.capitalize()} {split_name}", total=total_batches):
-        batch = texts[i:i + batch_size]
+            total_embedded += await embed_language(
+                lang_name, voyage_api_key, data_dir, session, bucket)
+
+    return total_embedded
+
+async def embed_dataset(dataset, output_path, voyage_api_key, lang_name,
+                        split_name, session, bucket):
+    """
+    Embed one prepared job and save embeddings.
+
+    Args:
+        dataset: Loaded HF dataset — a single split, or all splits of a
+            language concatenated into one job
+        output_path: Path to save embeddings (.npy)
+        voyage_api_key: Voyage API key
+        lang_name: Language name (for progress display)
+        split_name: Split label (train/validation/test, or 'all')
+        session: Shared aiohttp.ClientSession (one per process, not per split)
+        bucket: Shared TokenBucket
+    """
+    import aiohttp
+
+    print(f"   Embedding {len(dataset):,} functions")
+
+    # Only the two columns the texts need — HF skips deserializing the rest
+    dataset = dataset.select_columns(['func_documentation_string', 'func_code_string'])
+    total = len(dataset)
+
+    # Arrow-native prep (concat + truncate + token counts) across 4 processes
+    print(f"   Preparing texts (map, num_proc=4)...")
+    prepared = prepare_texts(dataset)
+
+    # Deduplicate before spending API budget: boilerplate (getters, setters,
+    # __init__s) repeats heavily in CodeSearchNet — each unique text is
+    # embedded once and copied to its duplicate rows afterwards (empirically
+    # 10-30% of a code corpus, straight off the bill and the clock)
+    hashes = prepared['text_hash']
+    inverse = np.empty(total, dtype=np.int64)
+    unique_rows = []
+    first_seen = {}
+    for j, h in enumerate(hashes):
+        k = first_seen.get(h)
+        if k is None:
+            k = len(unique_rows)
+            first_seen[h] = k
+            unique_rows.append(j)
+        inverse[j] = k
+    del hashes, first_seen
+    unique_rows = np.asarray(unique_rows, dtype=np.int64)
+    n_unique = len(unique_rows)
+    if n_unique < total:
+        print(f"   Dedupe: {n_unique:,} unique texts ({total - n_unique:,} duplicates skip the API)")
+    prepared = prepared.select(unique_rows)
+
+    # Batch in length-sorted order (short texts pack 200+ per request instead
+    # of being dragged down by a stray long one); results scatter back to
+    # original dataset positions, so the output order never changes
+    order = length_order(prepared)
+    sorted_ds = prepared.select(order)
+    # Original dataset row for each sorted-unique position
+    dest_rows = unique_rows[order]
+
+    # Batch embedding with Voyage AI — async pipeline, 10 batches in flight.
+    # Batch sizes are token-packed (TOKEN_BUDGET), not a fixed count.
+    print(f"   Starting batch embedding...")
 
-        # Call Voyage API
+    # Output goes straight to a .npy memmap: no 2 GB list-of-lists in RAM, no
+    # transient np.array() copy at the end, and a crash loses at most the
+    # unflushed window instead of the whole split. A .progress sidecar records
+    # the contiguous completed row count; restarts reopen in place and resume.
+    progress_path = Path(str(output_path) + '.progress')
+    resume_offset = 0
+    if output_path.exists() and progress_path.exists():
+        embeddings_array = np.lib.format.open_memmap(str(output_path), mode='r+')
+        if embeddings_array.shape == (total, 1024):
+            resume_offset = int(progress_path.read_text().strip() or 0)
+            print(f"   Resuming: {resume_offset:,}/{total:,} rows already embedded")
+        else:
+            embeddings_array = np.lib.format.open_memmap(
+                str(output_path), mode='w+', dtype=np.float16, shape=(total, 1024))
+    else:
+        embeddings_array = np.lib.format.open_memmap(
+            str(output_path), mode='w+', dtype=np.float16, shape=(total, 1024))
+
+    # Vectors are L2-normalized and stored as float16: cosine/HNSW search only
+    # needs direction, and halving bytes halves disk + import bandwidth
+    # (~8 GB → ~4 GB across all splits). The sidecar records the dtype so
+    # downstream loaders don't have to guess.
+    meta_path = Path(str(output_path) + '.meta.json')
+    meta_path.write_bytes(_json_dumps({'dtype': 'float16', 'normalized': True, 'dim': 1024}))
+
+    # Contiguous-completion watermark, counted in the deterministic
+    # length-sorted order: batches finish out of order, so completed slices
+    # park until the watermark reaches them, then the memmap is flushed and
+    # the watermark persisted (every ~100 batches)
+    watermark = [resume_offset]
+    parked = {}
+    batches_since_flush = [0]
+
+    def persist_progress():
+        embeddings_array.flush()
+        tmp = progress_path.with_suffix('.progress.tmp')
+        tmp.write_text(str(watermark[0]))
+        tmp.replace(progress_path)
+        batches_since_flush[0] = 0
+
+    def advance_progress(start, count):
+        parked[start] = count
+        while watermark[0] in parked:
+            watermark[0] += parked.pop(watermark[0])
+        batches_since_flush[0] += 1
+        if batches_since_flush[0] >= 100:
+            persist_progress()
+
+    async def post_batch(i, batch, pbar):
+        """Embed one prepared batch and write its slice; retries transient errors."""
         max_retries = 3
         for retry in range(max_retries):
             try:
-                response = requests.post(
+                await bucket.acquire()
+                async with session.post(
                     'https://api.voyageai.com/v1/embeddings',
                     headers={
                         'Authorization': f'Bearer {voyage_api_key}',
                         'Content-Type': 'application/json',
+                        'Accept-Encoding': 'gzip, deflate',  # aiohttp auto-decompresses
                     },
-                    json={
+                    data=_json_dumps({
                         'model': 'voyage-code-3',  # Code-optimized model (1024-dim)
                         'input': batch,
                         'input_type': 'document',  # Document mode for indexing
-                    },
-                    timeout=120
-                )
-
-                if response.status_code != 200:
-                    print(f"\n      ERROR: Voyage API returned {response.status_code}")
-                    print(f"      Response: {response.text}")
-                    if retry < max_retries - 1:
-                        print(f"      Retrying in 10s... (attempt {retry + 2}/{max_retries})")
-                        time.sleep(10)
+                        # Raw floats over base64: ~5x smaller than JSON float
+                        # text and decodes with one frombuffer instead of
+                        # parsing 1024 number literals per vector. These are
+                        # the documented parameter names — output_dtype takes
+                        # 'float' (not 'float32') and the transport knob is
+                        # encoding_format; the isinstance check below still
+                        # guards against a server that ignores them
+                        'output_dtype': 'float',
+                        'encoding_format': 'base64',
+                        # cl100k_base is only a proxy for Voyage's tokenizer:
+                        # let the server clip the rare text our exact-clip
+                        # still leaves over its limit, instead of 400-failing
+                        'truncation': True,
+                    }),
+                    timeout=aiohttp.ClientTimeout(total=120)
+                ) as response:
+                    if response.status == 429:
+                        # Server tells us exactly when to come back
+                        retry_after = response.headers.get('retry-after', '1')
+                        bucket.penalize(retry_after)
+                        print(f"\n      429 rate limited, holding {retry_after}s...")
                         continue
-                    else:
-                        sys.exit(1)
-
-                data = response.json()
-                batch_embeddings = [item['embedding'] for item in data['data']]
-                embeddings.extend(batch_embeddings)
-                break  # Success, exit retry loop
-
-            except requests.exceptions.Timeout:
-                if retry < max_retries - 1:
-                    print(f"\n      Timeout, retrying in 10s... (attempt {retry + 2}/{max_retries})")
-                    time.sleep(10)
-                else:
-                    print(f"\n      ERROR: Max retries exceeded")
-                    sys.exit(1)
 
-            except Exception as e:
+                    bucket.observe(response.headers)
+                    if response.status != 200:
+                        body = await response.text()
+                        print(f"\n      ERROR: Voyage API returned {response.status}")
+                        print(f"      Response: {body}")
+                        if retry < max_retries - 1:
+                            print(f"      Retrying in 10s... (attempt {retry + 2}/{max_retries})")
+                            await asyncio.sleep(10)
+                            continue
+                        raise RuntimeError(f"API error after {max_retries} retries")
+
+                    data = _json_loads(await response.read())
+                    items = data['data']
+                    if items and isinstance(items[0]['embedding'], str):
+                        arr = np.frombuffer(
+                            b''.join(base64.b64decode(item['embedding']) for item in items),
+                            dtype='<f4').reshape(len(items), 1024).copy()
+                    else:
+                        # Server ignored the encoding hint — plain JSON floats
+                        arr = np.asarray(
+                            [item['embedding'] for item in items], dtype=np.float32)
+                    # Normalize in float32, store as float16 (cast on assignment);
+                    # scatter rows back to their original dataset positions
+                    arr /= np.linalg.norm(arr, axis=1, keepdims=True)
+                    embeddings_array[dest_rows[i:i + len(batch)]] = arr
+                    advance_progress(i, len(batch))
+                    pbar.update(1)
+                    return len(batch)
+
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
                 if retry < max_retries - 1:
                     print(f"\n      Error: {str(e)}, retrying in 10s... (attempt {retry + 2}/{max_retries})")
-                    time.sleep(10)
+                    await asyncio.sleep(10)
                 else:
-                    print(f"\n      ERROR: Failed after {max_retries} retries")
-                    print(f"      Error: {str(e)}")
-                    sys.exit(1)
-
-        # Rate limiting: 100 requests/minute for Voyage AI
-        time.sleep(0.6)  # ~100 req/min
-
-    # Convert to numpy array and save
-    embeddings_array = np.array(embeddings, dtype=np.float32)
-    np.save(output_path, embeddings_array)
+                    raise RuntimeError(f"Failed after {max_retries} retries: {e}")
+        raise RuntimeError(f"Batch at offset {i} still rate limited after {max_retries} attempts")
+
+    # Windowed task set (10 in flight) bounds both concurrency and live text
+    # memory; the shared session means no TLS handshake per split either
+    embedded = 0
+    with tqdm(desc=f"   {lang_name.capitalize()} {split_name}", unit="batch") as pbar:
+        in_flight = set()
+        # Ctrl-C (or any mid-run failure) must not lose completed work: the
+        # finally persists the watermark and flushes the memmap, so a restart
+        # resumes at the exact row instead of redoing hours of a large job
+        try:
+            for i, batch in iter_text_batches(sorted_ds):
+                # Rows finished by a previous (interrupted) run: no API call
+                if i + len(batch) <= resume_offset:
+                    continue
+                in_flight.add(asyncio.ensure_future(post_batch(i, batch, pbar)))
+                if len(in_flight) >= 10:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        embedded += task.result()
+            for task in asyncio.as_completed(in_flight):
+                embedded += await task
+        finally:
+            for task in in_flight:
+                task.cancel()
+            persist_progress()
+
+    # Fan embeddings out from each first occurrence to its duplicate rows
+    if n_unique < total:
+        src = unique_rows[inverse]  # Original row holding each row's vector
+        dup = np.flatnonzero(src != np.arange(total))
+        for c in range(0, len(dup), 10000):
+            idx = dup[c:c + 10000]
+            embeddings_array[idx] = embeddings_array[src[idx]]
+
+    # Everything is already on disk via the memmap; the sidecar comes off to
+    # mark the split complete (main() skips splits with no .progress file)
+    embeddings_array.flush()
+    if progress_path.exists():
+        progress_path.unlink()
     print(f"   Saved embeddings: {output_path.name}")
     print(f"   Shape: {embeddings_array.shape}")
     print()
 
-    return len(embeddings)
+    return total
 
 def main():
     print("=" * 80)
@@ -175,13 +632,13 @@ def main():
 
     # Check dependencies
     try:
-        import requests
+        import aiohttp  # noqa: F401 (used by embed_dataset)
         from datasets import load_from_disk
     except ImportError as e:
         print(f"ERROR: Missing dependency: {e}")
         print()
         print("Install with:")
-        print("  pip install requests datasets tqdm numpy")
+        print("  pip install aiohttp datasets tqdm numpy")
         sys.exit(1)
 
     # Overview
@@ -199,14 +656,14 @@ def main():
     print()
 
     print(f"Model: voyage-code-3 (code-optimized, 1024-dim)")
-    print(f"Batch size: 32 functions/batch (FIXED: reduced from 64)")
-    print(f"Text truncation: Adaptive 15K-30K chars (FIXED: prevents token limit errors)")
-    print(f"Rate limit: 100 requests/minute")
-    print(f"Estimated time: 36-50 hours")
+    print(f"Batching: token-packed to {TOKEN_BUDGET:,} tokens/request (was fixed 32)")
+    print(f"Text truncation: adaptive char ladder + exact 8K-token clip when tiktoken present")
+    print(f"Rate limit: 100 requests/minute (10 batches in flight)")
+    print(f"Estimated time: ~6-8 hours (async pipeline; was 36-50 sequential)")
     print()
 
     # Confirm
-    print("WARNING: This will cost ~$24 and take 36-50 hours")
+    print("WARNING: This will cost ~$24 and take ~6-8 hours")
     print()
 
     # Process each language × split
@@ -219,30 +676,12 @@ def main():
         sys.exit(1)
 
     start_time = time.time()
-    total_embedded = 0
-
-    for lang_name in LANGUAGES.keys():
-        print("=" * 80)
-        print(f"Embedding {lang_name.upper()} (all splits)")
-        print("=" * 80)
-        print()
-
-        for split_name in SPLITS:
-            dataset_path = data_dir / f"{lang_name}_{split_name}"
-            embeddings_path = data_dir / f"{lang_name}_{split_name}_embeddings.npy"
 
-            if not dataset_path.exists():
-                print(f"   WARNING: Dataset not found: {dataset_path.name}, skipping...")
-                print()
-                continue
-
-            if embeddings_path.exists():
-                print(f"   Embeddings already exist: {embeddings_path.name}, skipping...")
-                print()
-                continue
-
-            count = embed_dataset(dataset_path, embeddings_path, voyage_api_key, lang_name, split_name)
-            total_embedded += count
+    try:
+        total_embedded = asyncio.run(run_all(voyage_api_key, data_dir))
+    except Exception as e:
+        print(f"\nERROR: {str(e)}")
+        sys.exit(1)
 
     elapsed_time = time.time() - start_time
 
@@ -256,14 +695,16 @@ def main():
     print(f"OK Embeddings saved to: {data_dir}")
     print()
 
-    # Validation
+    # Validation — map (not read) each combined file and check the offsets
     print("Validating embeddings...")
     for lang_name in LANGUAGES.keys():
-        for split_name in SPLITS:
-            embeddings_path = data_dir / f"{lang_name}_{split_name}_embeddings.npy"
-            if embeddings_path.exists():
-                embeddings = np.load(embeddings_path)
-                print(f"   OK {embeddings_path.name}: {embeddings.shape}")
+        embeddings_path = data_dir / f"{lang_name}_all_embeddings.npy"
+        offsets_path = data_dir / f"{lang_name}_offsets.json"
+        if embeddings_path.exists():
+            embeddings = np.load(embeddings_path, mmap_mode='r')
+            offsets = _json_loads(offsets_path.read_bytes()) if offsets_path.exists() else {}
+            splits = ', '.join(f"{k}={b - a:,}" for k, (a, b) in offsets.items())
+            print(f"   OK {embeddings_path.name}: {embeddings.shape} ({splits})")
     print()
 
     # Next steps